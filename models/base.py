@@ -4,7 +4,7 @@ import torch
 import torch.utils.checkpoint as checkpoint
 from einops import rearrange
 from einops.layers.torch import Reduce
-from timm.models.layers import DropPath, trunc_normal_
+from timm.models.layers import DropPath, is_scriptable, trunc_normal_
 from timm.models.vision_transformer import Mlp
 from torch import nn
 
@@ -51,6 +51,16 @@ def _cfg_columnar(**kwargs):
     return cfg
 
 
+def _script_attn(layers):
+    # script at block granularity, the einops layout ops around the attention are not scriptable
+    for layer in layers:
+        for blk in layer.blocks:
+            scripted = torch.jit.script(blk.attn)
+            # scripting drops the state_dict pre-hooks that upgrade older checkpoints
+            scripted._load_state_dict_pre_hooks.update(blk.attn._load_state_dict_pre_hooks)
+            blk.attn = scripted
+
+
 class Block(nn.Module):
 
     def __init__(
@@ -286,6 +296,8 @@ class StageTransformer(nn.Module):
         self.head = nn.Linear(self.num_features, num_classes) if num_classes > 0 else nn.Identity()
 
         self.apply(self._init_weights)
+        if is_scriptable():
+            _script_attn(self.layers)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -414,6 +426,8 @@ class ColumnarTransformer(nn.Module):
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
         self.apply(self._init_weights)
+        if is_scriptable():
+            _script_attn(self.layers)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -1,10 +1,28 @@
 from functools import partial
 
-from einops import rearrange
+import torch
 from timm.models import register_model
 from torch import nn
+from torch.nn import functional as F
 
 from .base import Block, StageTransformer, _cfg_pyramid
+from .module import maybe_compile
+
+
+def _efficient_attn_core(
+    q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, attn_drop: float = 0.0
+) -> torch.Tensor:
+    # softmax, context dropout and both matmuls compile into one fused graph
+    q = q.softmax(dim=-1)  # B H N C
+    kt = k.transpose(-2, -1).softmax(dim=-1)  # B H C N
+
+    context = kt @ v
+    if attn_drop > 0.0:
+        context = F.dropout(context, attn_drop)
+    return q @ context
+
+
+_efficient_attn_core_compiled = maybe_compile(fullgraph=True)(_efficient_attn_core)
 
 
 class EfficientAttention(nn.Module):
@@ -25,26 +43,31 @@ class EfficientAttention(nn.Module):
         self.head_dim = dim // num_heads
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.attn_drop = float(attn_drop)  # applied functionally inside _efficient_attn_core
         self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-
-    def forward(self, x):
-        qkv = rearrange(self.qkv(x), "B N (qkv H C) -> qkv B H N C", qkv=3, H=self.num_heads)
-        q, kt, v = [
-            qkv[0].softmax(dim=-1),  # B H N C
-            rearrange(qkv[1], "B H N C -> B H C N").softmax(dim=-1),
-            qkv[2],  # B H N C
-        ]  # make torchscript happy (cannot use tensor as tuple)
+        self.proj_drop = nn.Dropout(proj_drop) if proj_drop > 0.0 else nn.Identity()
 
-        context = kt @ v
-        context = self.attn_drop(context)
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, N, C = x.shape
+        q, k, v = [
+            t.reshape(B, N, self.num_heads, self.head_dim).transpose(1, 2)  # B H N C
+            for t in self.qkv(x).chunk(3, dim=-1)
+        ]
+        # the chunks are stride-3C views, q and k are rewritten contiguously by their softmax but v
+        # feeds the context matmul directly, so copy it once
+        v = v.contiguous()
 
-        x = rearrange(q @ context, "B H N C -> B N (H C)")
+        attn_drop = self.attn_drop if self.training else 0.0
+        if torch.jit.is_scripting():
+            x = _efficient_attn_core(q, k, v, attn_drop)
+        else:
+            x = _efficient_attn_core_compiled(q, k, v, attn_drop)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+    @torch.jit.ignore
     def flops(self):  # O(NC^2)
         N = self.input_resolution[0] * self.input_resolution[1]
         # calculate flops for token length of N
@@ -53,7 +76,7 @@ class EfficientAttention(nn.Module):
         flops += N * self.dim * 3 * self.dim
         # context = kt @ v
         flops += self.num_heads * self.head_dim * N * self.head_dim
-        # x = rearrange(q @ context, "B H N C -> B N (H C)")
+        # x = q @ context
         flops += self.num_heads * N * self.head_dim * self.head_dim
         # x = self.proj(x)
         flops += N * self.dim * self.dim
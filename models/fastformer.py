@@ -1,11 +1,47 @@
 from functools import partial
 
 import torch
-from einops import rearrange, reduce
 from timm.models import register_model
 from torch import nn
+from torch.nn import functional as F
 
 from .base import Block, StageTransformer, _cfg_pyramid
+from .module import maybe_compile
+
+
+def _fast_attn_core(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    w_q: torch.Tensor,
+    w_k: torch.Tensor,
+    attn_drop: float = 0.0,
+) -> torch.Tensor:
+    # additive attention over B H N C heads, kept free of einops so it traces as a single graph
+    # alpha / beta are one batched (N x C) @ (C x 1) matmul over all B H heads
+    alpha = torch.matmul(q, w_q.transpose(-2, -1)).squeeze(-1)  # B H N
+    alpha = alpha.softmax(dim=-1)
+    global_q = torch.matmul(alpha.unsqueeze(-2), q).squeeze(-2)  # B H C
+
+    p = global_q.unsqueeze(-2) * k
+    if attn_drop > 0.0:
+        p = F.dropout(p, attn_drop)
+    beta = torch.matmul(p, w_k.transpose(-2, -1)).squeeze(-1)  # B H N
+    beta = beta.softmax(dim=-1)
+    global_k = torch.matmul(beta.unsqueeze(-2), k).squeeze(-2)  # B H C
+
+    return global_k.unsqueeze(-2) * v
+
+
+_fast_attn_core_compiled = maybe_compile(fullgraph=True)(_fast_attn_core)
+
+
+def _upgrade_w_qk(state_dict, prefix, *args, num_heads, head_dim):
+    # checkpoints from before the pre-broadcast layout store w_q / w_k as H C
+    for name in ("w_q", "w_k"):
+        w = state_dict.get(prefix + name)
+        if w is not None and w.dim() == 2:
+            state_dict[prefix + name] = w.reshape(1, num_heads, 1, head_dim)
 
 
 class FastAttention(nn.Module):
@@ -23,44 +59,61 @@ class FastAttention(nn.Module):
         self.dim = dim
         self.input_resolution = input_resolution
         self.num_heads = num_heads
-        self.num_heads = num_heads
         self.head_dim = dim // num_heads
         self.scale = self.head_dim ** -0.5
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.attn_drop = float(attn_drop)  # applied functionally inside _fast_attn_core
         self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-        self.w_q = nn.Parameter(torch.randn(num_heads, self.head_dim))
-        self.w_k = nn.Parameter(torch.randn(num_heads, self.head_dim))
+        self.proj_drop = nn.Dropout(proj_drop) if proj_drop > 0.0 else nn.Identity()
+        # w_q / w_k are stored pre-broadcast to 1 H 1 C
+        self.w_q = nn.Parameter(torch.randn(1, num_heads, 1, self.head_dim))
+        self.w_k = nn.Parameter(torch.randn(1, num_heads, 1, self.head_dim))
+        self._register_load_state_dict_pre_hook(
+            partial(_upgrade_w_qk, num_heads=num_heads, head_dim=self.head_dim)
+        )
 
-    def forward(self, x):
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, N, C = x.shape
-        qkv = rearrange(self.qkv(x), "B N (qkv H C) -> qkv B H N C", qkv=3, H=self.num_heads)
-        q, k, v = qkv.unbind(0)  # make torchscript happy (cannot use tensor as tuple)
-
-        alpha = torch.einsum("BHNC,HC->BHN", q, self.w_q) * self.scale
-        alpha = alpha.softmax(dim=-1)
-        global_q = torch.einsum("BHN,BHNC->BHNC", alpha, q)
-        global_q = reduce(global_q, "B H N C -> B H C", "sum")
-
-        p = torch.einsum("BHC,BHNC -> BHNC", global_q, k)
-        p = self.attn_drop(p)
-        beta = torch.einsum("BHNC,HC->BHN", p, self.w_k) * self.scale
-        beta = beta.softmax(dim=-1)
-        global_k = torch.einsum("BHN,BHNC->BHNC", beta, k)
-        global_k = reduce(global_k, "B H N C -> B H C", "sum")
-
-        u = torch.einsum("BHC,BHNC->BHNC", global_k, v)
-
-        q = rearrange(q, "B H N C -> B N (H C)")
-        u = rearrange(u, "B H N C -> B N (H C)")
-        x = self.proj(u) + q
+        q, k, v = self.qkv(x).chunk(3, dim=-1)  # B N C each, no 5-D permute of the qkv output
+        # the chunks are stride-3C views, copy q and k once into contiguous B H N C heads so the
+        # matmuls below don't each gather them again (v is only used elementwise)
+        qh, kh, vh = [
+            t.reshape(B, N, self.num_heads, self.head_dim).transpose(1, 2)  # B H N C
+            for t in (q, k, v)
+        ]
+        qh, kh = qh.contiguous(), kh.contiguous()
+        # scale the tiny 1 H 1 C weights rather than the B H N scores, and keep the reductions in
+        # bf16/fp16 under autocast
+        w_q = (self.w_q * self.scale).to(q.dtype)
+        w_k = (self.w_k * self.scale).to(q.dtype)
+        attn_drop = self.attn_drop if self.training else 0.0
+        if torch.jit.is_scripting():
+            u = _fast_attn_core(qh, kh, vh, w_q, w_k, attn_drop)
+        else:
+            u = _fast_attn_core_compiled(qh, kh, vh, w_q, w_k, attn_drop)
+
+        u = u.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(u).add_(q)  # residual added into the projection output, no extra B N C buffer
         x = self.proj_drop(x)
         return x
 
-    def flops(self):
-        return NotImplementedError
+    @torch.jit.ignore
+    def flops(self):  # O(NC^2)
+        N = self.input_resolution[0] * self.input_resolution[1]
+        # calculate flops for token length of N
+        flops = 0
+        # q, k, v = self.qkv(x)
+        flops += N * self.dim * 3 * self.dim
+        # alpha = q @ w_q, global_q = alpha @ q
+        flops += 2 * self.num_heads * N * self.head_dim
+        # p = global_q * k, beta = p @ w_k, global_k = beta @ k
+        flops += 3 * self.num_heads * N * self.head_dim
+        # u = global_k * v
+        flops += self.num_heads * N * self.head_dim
+        # x = self.proj(u)
+        flops += N * self.dim * self.dim
+        return flops
 
 
 @register_model
@@ -6,6 +6,21 @@ from timm.models.layers import to_2tuple
 from torch import nn
 
 
+def maybe_compile(**compile_kwargs):
+    """Decorate a function with ``torch.compile`` when it is available (PyTorch >= 2.0).
+
+    TorchScript cannot compile through the ``torch.compile`` wrapper, so scriptable modules keep the
+    undecorated function around and call it under ``torch.jit.is_scripting()``.
+    """
+
+    def decorator(fn):
+        if hasattr(torch, "compile"):
+            return torch.compile(fn, **compile_kwargs)
+        return fn
+
+    return decorator
+
+
 class PatchMerging(nn.Module):
 
     def __init__(self, input_resolution, dim, norm_layer=nn.LayerNorm):
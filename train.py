@@ -6,9 +6,11 @@ import json
 from collections import OrderedDict
 from contextlib import suppress
 from datetime import datetime
+from functools import partial
+from types import SimpleNamespace
 
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.utils
 import yaml
 from timm.data import (
@@ -31,10 +33,16 @@ from timm.models import (
 from timm.optim import create_optimizer_v2, optimizer_kwargs
 from timm.scheduler import create_scheduler
 from timm.utils import *
-from timm.utils import ApexScaler, NativeScaler
+from timm.utils import ApexScaler
 from torch.nn.parallel import DistributedDataParallel as NativeDDP
 
-from utils import update_summary
+from utils import (
+    NativeGradScaler,
+    PrefetchLoader,
+    fast_collate,
+    set_prefetch_factor,
+    update_summary,
+)
 
 try:
     from apex import amp
@@ -67,6 +75,12 @@ import models
 warnings.filterwarnings("ignore")
 
 torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.deterministic = False
+# TF32 tensor cores for the fp32 (non-AMP) matmuls and convolutions on Ampere and newer
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+if hasattr(torch, "set_float32_matmul_precision"):
+    torch.set_float32_matmul_precision("high")
 _logger = logging.getLogger("train")
 
 config_parser = parser = argparse.ArgumentParser(description="Training Config", add_help=False)
@@ -98,6 +112,13 @@ parser.add_argument(
     default=False,
     help="use NVIDIA Apex AMP or Native AMP for mixed precision training",
 )
+parser.add_argument(
+    "--amp-dtype",
+    default=None,
+    type=str,
+    choices=["fp16", "bf16"],
+    help="native AMP autocast dtype (default: bf16 on Ampere or newer GPUs, else fp16)",
+)
 
 parser.add_argument(
     "--experiment",
@@ -135,6 +156,30 @@ parser.add_argument(
     "--epochs", type=int, default=300, metavar="N", help="number of epochs to train (default: 300)"
 )
 
+parser.add_argument(
+    "--compile",
+    action=argparse.BooleanOptionalAction,
+    default=hasattr(torch, "compile"),
+    help="compile the model with torch.compile (default: on for PyTorch >= 2.0)",
+)
+
+parser.add_argument(
+    "--prefetch-factor",
+    type=int,
+    default=4,
+    metavar="N",
+    help="batches loaded in advance by each data loader worker, not applied with "
+    "--use-multi-epochs-loader (default: 4)",
+)
+
+parser.add_argument(
+    "--grad-accum-steps",
+    type=int,
+    default=1,
+    metavar="N",
+    help="number of batches to accumulate gradients over before an optimizer step (default: 1)",
+)
+
 
 #--------------------------------------------------------------------------------------------------------------
 
@@ -151,8 +196,8 @@ def _parse_args():
     # The main arg parser parses the rest of the args, the usual
     # defaults will have been overridden if config file specified.
     args = parser.parse_args(remaining)
-    parser_args = {}
-    parser_args = json.load(open("/content/computer_vision/args.txt"))
+    with open("/content/computer_vision/args.txt") as f:
+        parser_args = json.load(f)
     for k, v in parser_args.items():
         parser.add_argument('--' + k, default=v)
 
@@ -186,6 +231,20 @@ def main():
         use_amp = "apex"
     elif args.native_amp and has_native_amp:
         use_amp = "native"
+        if args.amp_dtype is None:
+            # bf16 tensor cores need sm_80+, is_bf16_supported() is also true for emulated bf16 (T4)
+            bf16_native = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+            args.amp_dtype = "bf16" if bf16_native else "fp16"
+
+    # channels-last is what lets native AMP convolutions hit the tensor-core kernels
+    args.channels_last = args.channels_last or use_amp == "native"
+
+    assert args.grad_accum_steps >= 1, "--grad-accum-steps must be at least 1"
+    # apex's scaler always steps inside its backward call, so it cannot accumulate
+    assert args.grad_accum_steps == 1 or use_amp != "apex", "--grad-accum-steps requires native AMP"
+
+    # the config is fully resolved from here on, keep it as a plain namespace
+    args = SimpleNamespace(**vars(args))
 
     random_seed(args.seed, args.rank)
 
@@ -228,10 +287,14 @@ def main():
         if args.local_rank == 0:
             _logger.info("Using NVIDIA APEX AMP. Training in mixed precision.")
     elif use_amp == "native":
-        amp_autocast = torch.cuda.amp.autocast
-        loss_scaler = NativeScaler()
+        amp_dtype = torch.bfloat16 if args.amp_dtype == "bf16" else torch.float16
+        amp_autocast = partial(torch.cuda.amp.autocast, dtype=amp_dtype)
+        # bf16 keeps fp32's exponent range, so its gradients don't underflow and need no scaling
+        loss_scaler = NativeGradScaler() if amp_dtype == torch.float16 else None
         if args.local_rank == 0:
-            _logger.info("Using native Torch AMP. Training in mixed precision.")
+            _logger.info(
+                "Using native Torch AMP ({}). Training in mixed precision.".format(args.amp_dtype)
+            )
     else:
         if args.local_rank == 0:
             _logger.info("AMP not enabled. Training in float32.")
@@ -245,6 +308,22 @@ def main():
         if args.resume:
             load_checkpoint(model_ema.module, args.resume, use_ema=True)
 
+    # compile once the optimizer, AMP and EMA are set up on the plain modules, which the optimizer
+    # param groups, EMA and checkpoint saver keep using (no "_orig_mod." prefixed state_dict keys)
+    forward_model = model
+    forward_model_ema = model_ema.module if model_ema is not None else None
+    if args.compile and not args.torchscript:
+        forward_model = torch.compile(model, mode="max-autotune", dynamic=False)
+        if model_ema is not None:
+            forward_model_ema = torch.compile(model_ema.module, mode="max-autotune", dynamic=False)
+        if args.local_rank == 0:
+            _logger.info("Model compiled with torch.compile.")
+
+    # the EMA parameter blend runs on its own stream, overlapping the next step's forward/backward
+    ema_stream = None
+    if model_ema is not None and not args.model_ema_force_cpu:
+        ema_stream = torch.cuda.Stream()
+
     # setup learning rate schedule and starting epoch
     lr_scheduler, num_epochs = create_scheduler(args, optimizer)
     start_epoch = 0
@@ -277,7 +356,7 @@ def main():
     )
 
     # setup mixup / cutmix
-    collate_fn = None
+    collate_fn = fast_collate if args.prefetcher else None
     mixup_fn = None
     mixup_active = args.mixup > 0 or args.cutmix > 0.0 or args.cutmix_minmax is not None
     if mixup_active:
@@ -349,24 +428,32 @@ def main():
         num_workers=args.workers,
         distributed=args.distributed,
         crop_pct=data_config["crop_pct"],
+        collate_fn=fast_collate if args.prefetcher else None,
         pin_memory=args.pin_mem,
     )
+    loader_train = set_prefetch_factor(loader_train, prefetch_factor=args.prefetch_factor)
+    loader_eval = set_prefetch_factor(loader_eval, prefetch_factor=args.prefetch_factor)
+
+    if args.prefetcher:
+        # swap in the prefetcher with the fused normalization kernel, producing batches already in
+        # the AMP dtype and model memory format
+        prefetch_args = dict(
+            dtype=amp_dtype if use_amp == "native" else None,
+            memory_format=torch.channels_last if args.channels_last else torch.contiguous_format,
+        )
+        loader_train = PrefetchLoader(loader_train, **prefetch_args)
+        loader_eval = PrefetchLoader(loader_eval, **prefetch_args)
 
     # setup loss function
-    if args.bce_loss:
-        train_loss_fn = BinaryCrossEntropy(target_threshold=args.bce_target_thresh)
-    else:
-        train_loss_fn = SoftTargetCrossEntropy()
-
     if args.bce_loss:
         train_loss_fn = BinaryCrossEntropy(
             smoothing=args.smoothing, target_threshold=args.bce_target_thresh
         )
     else:
-        train_loss_fn = LabelSmoothingCrossEntropy(smoothing=args.smoothing)
-
-    train_loss_fn = train_loss_fn.cuda()
-    validate_loss_fn = nn.CrossEntropyLoss().cuda()
+        # mixup targets are already smoothed
+        smoothing = 0.0 if mixup_active else args.smoothing
+        train_loss_fn = partial(F.cross_entropy, label_smoothing=smoothing)
+    validate_loss_fn = F.cross_entropy
 
     # setup checkpoint saver and eval metric tracking
     eval_metric = args.eval_metric
@@ -406,7 +493,7 @@ def main():
 
             train_metrics = train_one_epoch(
                 epoch,
-                model,
+                forward_model,
                 loader_train,
                 optimizer,
                 train_loss_fn,
@@ -417,16 +504,20 @@ def main():
                 amp_autocast=amp_autocast,
                 loss_scaler=loss_scaler,
                 model_ema=model_ema,
+                ema_stream=ema_stream,
                 mixup_fn=mixup_fn,
             )
+            if ema_stream is not None:
+                # the EMA weights are evaluated and checkpointed below
+                torch.cuda.current_stream().wait_stream(ema_stream)
 
             eval_metrics = validate(
-                model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast
+                forward_model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast
             )
 
             if model_ema is not None and not args.model_ema_force_cpu:
                 ema_eval_metrics = validate(
-                    model_ema.module,
+                    forward_model_ema,
                     loader_eval,
                     validate_loss_fn,
                     args,
@@ -463,6 +554,23 @@ def main():
         _logger.info("*** Best metric: {0} (epoch {1})".format(best_metric, best_epoch))
 
 
+def _split_ema_state(model_ema, model):
+    """Pair up the ``ModelEmaV2`` and model state the way ``ModelEmaV2.update`` does, split into
+    (parameters, buffers) lists of ``(ema_tensor, model_tensor)``."""
+    param_names = {name for name, _ in model_ema.module.named_parameters()}
+    params, buffers = [], []
+    ema_state = model_ema.module.state_dict()
+    for (name, ema_v), model_v in zip(ema_state.items(), model.state_dict().values()):
+        (params if name in param_names else buffers).append((ema_v, model_v))
+    return params, buffers
+
+
+@torch.no_grad()
+def _ema_blend(pairs, decay):
+    for ema_v, model_v in pairs:
+        ema_v.copy_(decay * ema_v + (1.0 - decay) * model_v)
+
+
 def train_one_epoch(
     epoch,
     model,
@@ -476,6 +584,7 @@ def train_one_epoch(
     amp_autocast=suppress,
     loss_scaler=None,
     model_ema=None,
+    ema_stream=None,
     mixup_fn=None,
 ):
 
@@ -485,66 +594,127 @@ def train_one_epoch(
         elif mixup_fn is not None:
             mixup_fn.mixup_enabled = False
 
+    # hoisted out of the loop: the clip parameter list and the per-step flags
     second_order = hasattr(optimizer, "is_second_order") and optimizer.is_second_order
+    prefetcher, channels_last, distributed = args.prefetcher, args.channels_last, args.distributed
+    clip_grad, clip_mode = args.clip_grad, args.clip_mode
+    log_interval, world_size = args.log_interval, args.world_size
+    clip_params = list(model_parameters(model, exclude_head="agc" in (clip_mode or "")))
+    if ema_stream is not None:
+        ema_params, ema_buffers = _split_ema_state(model_ema, model)
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
     losses_m = AverageMeter()
+    # accumulate the loss on device and only read it back (a blocking D2H copy) at log points
+    loss_sum = torch.zeros((), device=args.device)
+    loss_count = 0
 
     model.train()
 
-    end = time.time()
+    # batch and data times are likewise summed over the log interval and reported as per-batch means
+    data_time = 0.0
+    interval_steps = 0
+
+    end = interval_start = time.time()
     last_idx = len(loader) - 1
-    num_updates = epoch * len(loader)
+    accum_steps = args.grad_accum_steps
+    # a trailing partial window steps on fewer micro-batches, its losses are divided by its own size
+    last_accum_steps = len(loader) % accum_steps or accum_steps
+    last_window_idx = len(loader) - last_accum_steps
+    num_updates = epoch * ((len(loader) + accum_steps - 1) // accum_steps)
+    optimizer.zero_grad(set_to_none=True)
     for batch_idx, (input, target) in enumerate(loader):
         last_batch = batch_idx == last_idx
-        data_time_m.update(time.time() - end)
-        if not args.prefetcher:
+        data_time += time.time() - end
+        interval_steps += 1
+        if not prefetcher:
             input, target = input.cuda(), target.cuda()
             if mixup_fn is not None:
                 input, target = mixup_fn(input, target)
-        if args.channels_last:
+        if channels_last:
             input = input.contiguous(memory_format=torch.channels_last)
 
         with amp_autocast():
             output = model(input)
             loss = loss_fn(output, target)
 
-        if not args.distributed:
-            losses_m.update(loss.item(), input.size(0))
-
-        optimizer.zero_grad()
-        if loss_scaler is not None:
-            loss_scaler(
-                loss,
-                optimizer,
-                clip_grad=args.clip_grad,
-                clip_mode=args.clip_mode,
-                parameters=model_parameters(model, exclude_head="agc" in args.clip_mode),
-                create_graph=second_order,
-            )
-        else:
-            loss.backward(create_graph=second_order)
-            if args.clip_grad is not None:
-                dispatch_clip_grad(
-                    model_parameters(model, exclude_head="agc" in args.clip_mode),
-                    value=args.clip_grad,
-                    mode=args.clip_mode,
+        if not distributed:
+            loss_sum += loss.detach() * input.size(0)
+            loss_count += input.size(0)
+
+        # only step (and all-reduce under DDP) on the last micro-batch of each accumulation window,
+        # scaling the loss so the accumulated gradient is the window mean
+        need_update = last_batch or (batch_idx + 1) % accum_steps == 0
+        window_steps = last_accum_steps if batch_idx >= last_window_idx else accum_steps
+        step_loss = loss / window_steps if window_steps > 1 else loss
+        sync_context = model.no_sync if distributed and not need_update else suppress
+        with sync_context():
+            if isinstance(loss_scaler, ApexScaler):
+                # apex scales, unscales, clips and steps inside one call (no accumulation, see main)
+                if ema_stream is not None:
+                    torch.cuda.current_stream().wait_stream(ema_stream)
+                loss_scaler(
+                    step_loss,
+                    optimizer,
+                    clip_grad=clip_grad,
+                    clip_mode=clip_mode,
+                    parameters=clip_params,
+                    create_graph=second_order,
                 )
-            optimizer.step()
-
-        if model_ema is not None:
-            model_ema.update(model)
+            elif loss_scaler is not None:
+                loss_scaler.scale(step_loss).backward(create_graph=second_order)
+            else:
+                step_loss.backward(create_graph=second_order)
+
+        if need_update:
+            if not isinstance(loss_scaler, ApexScaler):
+                if ema_stream is not None:
+                    # the step rewrites the parameters the previous EMA blend may still be reading
+                    torch.cuda.current_stream().wait_stream(ema_stream)
+                if clip_grad is not None:
+                    if loss_scaler is not None:
+                        # clip the true gradients, step() then skips the unscale it would do
+                        loss_scaler.unscale_(optimizer)
+                    dispatch_clip_grad(clip_params, value=clip_grad, mode=clip_mode)
+                if loss_scaler is not None:
+                    loss_scaler.step(optimizer)
+                    loss_scaler.update()
+                else:
+                    optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+            if ema_stream is not None:
+                # the next forward updates buffers (BatchNorm stats) in place, so only the
+                # parameters, untouched until the next optimizer step, go to the side stream
+                _ema_blend(ema_buffers, model_ema.decay)
+                ema_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(ema_stream):
+                    _ema_blend(ema_params, model_ema.decay)
+            elif model_ema is not None:
+                model_ema.update(model)
+
+            num_updates += 1
+        log_batch = last_batch or batch_idx % log_interval == 0
+        if log_batch:
+            # only wait for the GPU when timings and the loss are about to be reported
+            torch.cuda.synchronize()
+            now = time.time()
+            batch_time_m.update((now - interval_start) / interval_steps, interval_steps)
+            data_time_m.update(data_time / interval_steps, interval_steps)
+            interval_start = now
+            data_time = 0.0
+            interval_steps = 0
 
-        torch.cuda.synchronize()
-        num_updates += 1
-        batch_time_m.update(time.time() - end)
-        if last_batch or batch_idx % args.log_interval == 0:
             lrl = [param_group["lr"] for param_group in optimizer.param_groups]
             lr = sum(lrl) / len(lrl)
 
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
+            if distributed:
+                reduced_loss = reduce_tensor(loss.data, world_size)
                 losses_m.update(reduced_loss.item(), input.size(0))
+            else:
+                losses_m.update((loss_sum / loss_count).item(), loss_count)
+                loss_sum.zero_()
+                loss_count = 0
 
             if args.local_rank == 0:
                 _logger.info(
@@ -560,8 +730,8 @@ def train_one_epoch(
                         100.0 * batch_idx / last_idx,
                         loss=losses_m,
                         batch_time=batch_time_m,
-                        rate=input.size(0) * args.world_size / batch_time_m.val,
-                        rate_avg=input.size(0) * args.world_size / batch_time_m.avg,
+                        rate=input.size(0) * world_size / batch_time_m.val,
+                        rate_avg=input.size(0) * world_size / batch_time_m.avg,
                         lr=lr,
                         data_time=data_time_m,
                     )
@@ -580,9 +750,11 @@ def train_one_epoch(
             and args.recovery_interval
             and (last_batch or (batch_idx + 1) % args.recovery_interval == 0)
         ):
+            if ema_stream is not None:
+                torch.cuda.current_stream().wait_stream(ema_stream)
             saver.save_recovery(epoch, batch_idx=batch_idx)
 
-        if lr_scheduler is not None:
+        if lr_scheduler is not None and need_update:
             lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
 
         end = time.time()
@@ -596,14 +768,26 @@ def train_one_epoch(
 
 
 
+def _accuracy_top1_top5(output, target):
+    """Top-1 and top-5 accuracy (in percent) from a single ``topk`` and comparison."""
+    _, pred = output.topk(min(5, output.size(1)), dim=1)
+    correct = pred.eq(target.unsqueeze(1))
+    acc1 = correct[:, :1].any(1).float().mean() * 100.0
+    acc5 = correct.any(1).float().mean() * 100.0
+    return acc1, acc5
+
+
 def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix=""):
     batch_time_m = AverageMeter()
-    losses_m = AverageMeter()
-    top1_m = AverageMeter()
-    top5_m = AverageMeter()
 
     model.eval()
 
+    # loss / top-1 / top-5 are summed on device and read back once at the end, apart from the
+    # progress lines on the logging rank
+    metric_sums = torch.zeros(3, device=args.device)
+    metric_count = 0
+    interval_steps = 0
+
     end = time.time()
     last_idx = len(loader) - 1
     with torch.no_grad():
@@ -627,7 +811,7 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix="")
                 target = target[0 : target.size(0) : reduce_factor]
 
             loss = loss_fn(output, target)
-            acc1, acc5 = accuracy(output, target, topk=(1, 5))
+            acc1, acc5 = _accuracy_top1_top5(output, target)
 
             if args.distributed:
                 reduced_loss = reduce_tensor(loss.data, args.world_size)
@@ -636,33 +820,41 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress, log_suffix="")
             else:
                 reduced_loss = loss.data
 
-            torch.cuda.synchronize()
-
-            losses_m.update(reduced_loss.item(), input.size(0))
-            top1_m.update(acc1.item(), output.size(0))
-            top5_m.update(acc5.item(), output.size(0))
+            batch_metrics = torch.stack([reduced_loss, acc1, acc5])
+            metric_sums += batch_metrics * output.size(0)
+            metric_count += output.size(0)
+            interval_steps += 1
 
-            batch_time_m.update(time.time() - end)
-            end = time.time()
             if args.local_rank == 0 and (last_batch or batch_idx % args.log_interval == 0):
+                (loss_val, acc1_val, acc5_val), (loss_avg, acc1_avg, acc5_avg) = torch.stack(
+                    [batch_metrics, metric_sums / metric_count]
+                ).tolist()
+                batch_time_m.update((time.time() - end) / interval_steps, interval_steps)
+                interval_steps = 0
+                end = time.time()
+
                 log_name = "Test" + log_suffix
                 _logger.info(
                     "{0}: [{1:>4d}/{2}]  "
                     "Time: {batch_time.val:.3f} ({batch_time.avg:.3f})  "
-                    "Loss: {loss.val:>7.4f} ({loss.avg:>6.4f})  "
-                    "Acc@1: {top1.val:>7.4f} ({top1.avg:>7.4f})  "
-                    "Acc@5: {top5.val:>7.4f} ({top5.avg:>7.4f})".format(
+                    "Loss: {3:>7.4f} ({4:>6.4f})  "
+                    "Acc@1: {5:>7.4f} ({6:>7.4f})  "
+                    "Acc@5: {7:>7.4f} ({8:>7.4f})".format(
                         log_name,
                         batch_idx,
                         last_idx,
+                        loss_val,
+                        loss_avg,
+                        acc1_val,
+                        acc1_avg,
+                        acc5_val,
+                        acc5_avg,
                         batch_time=batch_time_m,
-                        loss=losses_m,
-                        top1=top1_m,
-                        top5=top5_m,
                     )
                 )
 
-    metrics = OrderedDict([("loss", losses_m.avg), ("top1", top1_m.avg), ("top5", top5_m.avg)])
+    loss_avg, acc1_avg, acc5_avg = metric_sums.div_(metric_count).tolist()
+    metrics = OrderedDict([("loss", loss_avg), ("top1", acc1_avg), ("top5", acc5_avg)])
 
     return metrics
 
@@ -1,33 +1,141 @@
 import csv
 from collections import OrderedDict
 
-import wandb
+import numpy as np
+import torch
+from timm.data.loader import MultiEpochsDataLoader
+from timm.data.loader import PrefetchLoader as _TimmPrefetchLoader
+from timm.data.loader import fast_collate as _timm_fast_collate
+
+from models.module import maybe_compile
 
 try:
     import wandb
 except ImportError:
-    pass
+    wandb = None
+
+# the resumed summary.csv is replayed to wandb once per run, and each summary file is kept open
+# (line buffered) for appending instead of being reopened every epoch
+_replayed = False
+_summary_files = {}
 
 
 def update_summary(epoch, train_metrics, eval_metrics, filename, write_header=False, log_wandb=False, resume=""):
+    global _replayed
     summary = OrderedDict(epoch=epoch)
     summary.update([("train_" + k, v) for k, v in train_metrics.items()])
     summary.update([("eval_" + k, v) for k, v in eval_metrics.items()])
+    log_wandb = log_wandb and wandb is not None
 
-    if log_wandb and resume != "":
+    if log_wandb and resume != "" and not _replayed:
         with open(filename, mode="r") as f:
             reader = csv.DictReader(f)
             for row in reader:
                 for key, value in row.items():
                     row[key] = float(value)
                 wandb.log(row)
+        _replayed = True
 
     if log_wandb:
         wandb.log(summary)
 
-    with open(filename, mode="a") as cf:
-        writer = csv.DictWriter(cf, fieldnames=summary.keys())
-        if write_header and (resume == ""):  # first iteration (epoch == 1 can't be used)
-            writer.writeheader()
-        writer.writerow(summary)
+    cf = _summary_files.get(filename)
+    if cf is None:
+        cf = _summary_files[filename] = open(filename, mode="a", buffering=1)
+    writer = csv.DictWriter(cf, fieldnames=summary.keys())
+    if write_header and (resume == ""):  # first iteration (epoch == 1 can't be used)
+        writer.writeheader()
+    writer.writerow(summary)
+
+
+def fast_collate(batch):
+    """``timm.data.fast_collate`` that fills the uint8 batch with one stacked copy instead of an
+    in-place add per sample."""
+    if isinstance(batch[0][0], tuple):
+        return _timm_fast_collate(batch)  # aug splits, deinterleaved by timm
+    targets = torch.tensor([b[1] for b in batch], dtype=torch.int64)
+    tensor = torch.empty((len(batch), *batch[0][0].shape), dtype=torch.uint8)
+    if isinstance(batch[0][0], np.ndarray):
+        np.stack([b[0] for b in batch], out=tensor.numpy())
+    else:
+        torch.stack([b[0] for b in batch], out=tensor)
+    return tensor, targets
+
+
+def set_prefetch_factor(loader, prefetch_factor=4):
+    """Rebuild a ``create_loader`` result with ``prefetch_factor``, which timm doesn't expose."""
+    if isinstance(loader, _TimmPrefetchLoader):
+        loader.loader = set_prefetch_factor(loader.loader, prefetch_factor)
+        return loader
+    # MultiEpochsDataLoader starts its workers on construction, a rebuild would start a second pool
+    if loader.num_workers == 0 or isinstance(loader, MultiEpochsDataLoader):
+        return loader
+    iterable = isinstance(loader.dataset, torch.utils.data.IterableDataset)
+    return type(loader)(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=None if iterable else loader.sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        worker_init_fn=loader.worker_init_fn,
+        persistent_workers=loader.persistent_workers,
+        prefetch_factor=prefetch_factor,
+    )
+
+
+class NativeGradScaler(torch.cuda.amp.GradScaler):
+    """``GradScaler`` checkpointed under the same key as timm's ``NativeScaler``."""
+
+    state_dict_key = "amp_scaler"
+
+
+@maybe_compile(fullgraph=True)
+def _normalize(x, mean, std, dtype, memory_format=torch.contiguous_format):
+    # one fused kernel, computed in fp32 so the output is rounded to the AMP dtype only once
+    return ((x.float() - mean) / std).to(dtype, memory_format=memory_format)
+
+
+class PrefetchLoader(_TimmPrefetchLoader):
+    """timm's CUDA prefetcher with a fused normalization producing batches in ``dtype`` and
+    ``memory_format``."""
+
+    def __init__(self, loader, dtype=None, memory_format=torch.contiguous_format):
+        self.loader = loader.loader
+        self.mean = loader.mean.float()
+        self.std = loader.std.float()
+        self.dtype = loader.mean.dtype if dtype is None else dtype
+        self.fp16 = loader.fp16
+        self.random_erasing = loader.random_erasing
+        self.memory_format = memory_format
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        first = True
+
+        for next_input, next_target in self.loader:
+            with torch.cuda.stream(stream):
+                next_input = next_input.cuda(non_blocking=True)
+                next_target = next_target.cuda(non_blocking=True)
+                next_input = _normalize(
+                    next_input, self.mean, self.std, self.dtype, self.memory_format
+                )
+                if self.random_erasing is not None:
+                    next_input = self.random_erasing(next_input)
+
+            if not first:
+                yield input, target
+            else:
+                first = False
+
+            # the batch is allocated on the side stream but consumed on the current one, record that
+            # use so the caching allocator can't hand its memory to the next copy while still in use
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(stream)
+            next_input.record_stream(current_stream)
+            next_target.record_stream(current_stream)
+            input = next_input
+            target = next_target
 
+        yield input, target